@@ -1,11 +1,72 @@
 # Chat interface
 
 # import the necessary libraries
-import json
+try:
+    # faster JSON decoding for the token stream, if available
+    import orjson as _json
+except ImportError:
+    import json as _json
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import streamlit as st
 from typing import Iterator
-import re
+
+# Show token usage and energy metrics in the sidebar
+SHOW_USAGE = True
+
+# Minimum interval (seconds) and chunk count between streamed UI updates
+FLUSH_INTERVAL = 0.05
+FLUSH_TOKENS = 16
+# Read size for the streamed HTTP body
+STREAM_CHUNK_SIZE = 65536
+
+# Delimiters of the model's thinking block
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+# Energy estimate: 35W under load for 0.02s per token, in gigajoules
+_GJ_PER_TOKEN = 35 * 0.02 / 1e9
+_KWH_PER_TOKEN = _GJ_PER_TOKEN * 277.778  # Convert GJ to kWh
+
+# Custom CSS for the chat page
+CUSTOM_CSS = """
+<style>
+.user-avatar {
+    width: 40px;
+    height: 40px;
+    border-radius: 50%;
+    background-color: #0068C9;
+    display: flex;
+    align-items: center;
+    justify-content: center;
+    color: white;
+}
+.assistant-avatar {
+    width: 40px;
+    height: 40px;
+    border-radius: 50%;
+    background-color: #09AB3B;
+    display: flex;
+    align-items: center;
+    justify-content: center;
+    color: white;
+}
+.chat-message {
+    padding: 1rem;
+    border-radius: 0.5rem;
+    margin-bottom: 1rem;
+    display: flex;
+    gap: 1rem;
+}
+.user-message {
+    background-color: #F0F2F6;
+}
+.assistant-message {
+    background-color: #FFFFFF;
+}
+</style>
+"""
 
 def init_session_state():
     """Initialize session state variables"""
@@ -19,59 +80,185 @@ def init_session_state():
 def extract_thinking_and_response(text: str) -> tuple[str | None, str]:
     """Extract thinking process and response from the text"""
     # Find content within <think> tags
-    think_match = re.search(r'<think>(.*?)</think>', text, re.DOTALL)
-    
-    if think_match:
-        thinking = think_match.group(1).strip()
-        # Remove the think tags and content from the response
-        response = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL).strip()
-        return thinking, response
+    start = text.find(THINK_OPEN)
+    end = text.find(THINK_CLOSE, start + len(THINK_OPEN)) if start >= 0 else -1
+    if end < 0:
+        # No complete thinking block yet
+        return None, text
     
-    return None, text
+    thinking = text[start + len(THINK_OPEN):end].strip()
+    # Remove every think block and its tags from the response
+    parts = []
+    pos = 0
+    while start >= 0 and end >= 0:
+        parts.append(text[pos:start])
+        pos = end + len(THINK_CLOSE)
+        start = text.find(THINK_OPEN, pos)
+        end = text.find(THINK_CLOSE, start + len(THINK_OPEN)) if start >= 0 else -1
+    parts.append(text[pos:])
+    response = "".join(parts).strip()
+    return thinking, response
 
-def get_ollama_response(prompt: str) -> Iterator[tuple[str, dict]]:
+def _parse_stream_line(line: bytes) -> tuple[str, str, dict]:
+    """Parse a single NDJSON line from the Ollama stream"""
+    json_response = _json.loads(line)
+    if "error" in json_response:
+        # Ollama reports failures mid-stream as an error line
+        raise requests.HTTPError(json_response["error"])
+    if json_response.get("done"):
+        # Return the final stats
+        return "", "", json_response
+    # Return the response and thinking chunks and empty stats
+    return json_response.get("response", ""), json_response.get("thinking", ""), {}
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """Get a shared HTTP session so connections to Ollama are kept alive"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+    session.mount("http://", adapter)
+    return session
+
+def _response_error(response: requests.Response) -> str:
+    """Get the error message from a failed Ollama response"""
+    try:
+        return _json.loads(response.content).get("error", response.reason)
+    except ValueError:
+        return response.text or response.reason
+
+def get_ollama_response(prompt: str) -> Iterator[tuple[str, str, dict]]:
     """Get streaming response from Ollama API"""
-    response = requests.post(
-        "http://localhost:11434/api/generate",
-        json={
-            "model": "deepseek-r1",
-            "prompt": prompt,
-            "stream": True
-        },
-        stream=True
-    )
-    
-    for line in response.iter_lines():
-        if line:
-            json_response = json.loads(line)
-            if json_response.get("done"):
-                # Return the final stats
-                yield "", json_response
-            else:
-                # Return the response chunk and empty stats
-                yield json_response.get("response", ""), {}
+    request = {
+        "model": "deepseek-r1",
+        "prompt": prompt,
+        "stream": True,
+        # Stream thinking in its own field instead of inline <think> tags
+        "think": True
+    }
+    while True:
+        # Close the response on early exit so the pooled connection is released
+        with get_http_session().post(
+            "http://localhost:11434/api/generate",
+            json=request,
+            stream=True
+        ) as response:
+            if not response.ok:
+                error = _response_error(response)
+                if "think" in request and "does not support thinking" in error:
+                    # Model has no thinking capability, ask again without it
+                    del request["think"]
+                    continue
+                raise requests.HTTPError(f"{response.status_code}: {error}", response=response)
+            response.raw.decode_content = True
+            
+            # Read large chunks and split the NDJSON stream on newlines ourselves
+            buf = bytearray()
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                buf += chunk
+                start = 0
+                nl = buf.find(b"\n")
+                while nl >= 0:
+                    line = bytes(buf[start:nl])
+                    if line.strip():
+                        yield _parse_stream_line(line)
+                    start = nl + 1
+                    nl = buf.find(b"\n", start)
+                del buf[:start]
+            
+            # Handle a trailing line without a newline
+            if buf.strip():
+                yield _parse_stream_line(bytes(buf))
+            return
 
 def display_thinking_section(thinking: str):
     """Display thinking process in a collapsible section"""
     with st.expander("💭 Show thinking process"):
         st.markdown(thinking)
 
+def stream_response_text(prompt: str, stream: dict, thinking_placeholder) -> Iterator[str]:
+    """Yield response text from Ollama with the thinking process split out"""
+    # st.write_stream redraws the whole answer per item, so coalesce chunks
+    pending = []
+    last_flush = time.monotonic()
+    for response_chunk, thinking_chunk, stats in get_ollama_response(prompt):
+        if thinking_chunk:
+            stream["think"].append(thinking_chunk)
+        if response_chunk:
+            stream["raw"].append(response_chunk)
+            
+            # Thinking sent in its own field is complete once the response starts
+            if stream["phase"] == "pre" and stream["think"] and not stream["thinking_displayed"]:
+                _show_thinking(stream, thinking_placeholder)
+            
+            # Route the chunk to the thinking or response buffer
+            resp_start = len(stream["resp"])
+            chunk = response_chunk
+            while chunk:
+                if stream["phase"] in ("pre", "post"):
+                    # Outside a think block; a later block is stripped like the first
+                    i = chunk.find(THINK_OPEN)
+                    if i < 0:
+                        stream["resp"].append(chunk)
+                        break
+                    if i > 0:
+                        stream["resp"].append(chunk[:i])
+                    chunk = chunk[i + len(THINK_OPEN):]
+                    stream["phase"] = "think"
+                else:
+                    i = chunk.find(THINK_CLOSE)
+                    if i < 0:
+                        stream["think"].append(chunk)
+                        break
+                    stream["think"].append(chunk[:i])
+                    chunk = chunk[i + len(THINK_CLOSE):]
+                    stream["phase"] = "post"
+                    # Display thinking section once it is complete
+                    _show_thinking(stream, thinking_placeholder)
+            
+            text = "".join(stream["resp"][resp_start:])
+            if text:
+                # The answer has started, so drop the thinking indicator
+                if stream["waiting"] and text.strip():
+                    thinking_placeholder.empty()
+                    stream["waiting"] = False
+                pending.append(text)
+                now = time.monotonic()
+                if now - last_flush >= FLUSH_INTERVAL or len(pending) >= FLUSH_TOKENS:
+                    yield "".join(pending)
+                    pending = []
+                    last_flush = now
+        elif stats:
+            # Update token count from final stats
+            if "prompt_eval_count" in stats:
+                st.session_state.total_tokens += stats["prompt_eval_count"]
+    
+    # Flush whatever is left once the stream ends
+    if pending:
+        yield "".join(pending)
+
+def _show_thinking(stream: dict, thinking_placeholder):
+    """Display the collected thinking process once"""
+    if stream["thinking_displayed"]:
+        return
+    thinking = "".join(stream["think"]).strip()
+    if thinking:
+        with thinking_placeholder:
+            display_thinking_section(thinking)
+        stream["thinking_displayed"] = True
+        stream["waiting"] = False
+
 def calculate_energy_consumption(num_tokens: int) -> float:
     """Calculate energy consumption in gigajoules based on token usage"""
-    power_watts = 35  # Power consumption under load in watts
-    runtime_per_token = 0.02  # Runtime per token in seconds
-    
-    total_runtime = runtime_per_token * num_tokens  # Total runtime in seconds
-    total_energy_joules = power_watts * total_runtime  # Energy in joules
-    energy_gj = total_energy_joules / 1e9  # Convert joules to gigajoules
-    return energy_gj
+    return num_tokens * _GJ_PER_TOKEN
 
-def display_token_counter():
+def display_token_counter(placeholder=None):
     """Display token counter and energy consumption in the sidebar"""
-    st.sidebar.markdown("### Usage Metrics")
+    # Render into the given placeholder so later calls replace the metrics
+    sidebar = placeholder.container() if placeholder else st.sidebar
+    sidebar.markdown("### Usage Metrics")
     
     # Token counter
-    st.sidebar.metric(
+    sidebar.metric(
         "Total Tokens Used",
         f"{st.session_state.total_tokens:,}",
         help="Total number of tokens processed by the model"
@@ -79,7 +266,7 @@ def display_token_counter():
     
     # Energy consumption
     energy_gj = calculate_energy_consumption(st.session_state.total_tokens)
-    st.sidebar.metric(
+    sidebar.metric(
         "Energy Consumption",
         f"{energy_gj:.6f} GJ",
         help=(
@@ -91,8 +278,8 @@ def display_token_counter():
     
     # Add equivalent metrics for context
     if energy_gj > 0:
-        energy_kwh = energy_gj * 277.778  # Convert GJ to kWh
-        st.sidebar.caption(
+        energy_kwh = st.session_state.total_tokens * _KWH_PER_TOKEN
+        sidebar.caption(
             f"Equivalent to:\n"
             f"• {energy_kwh:.2f} kWh of electricity\n"
             f"• Running a 60W light bulb for {(energy_kwh/0.06):.1f} hours"
@@ -110,43 +297,7 @@ def main():
     init_session_state()
 
     # Custom CSS
-    st.markdown("""
-        <style>
-        .user-avatar {
-            width: 40px;
-            height: 40px;
-            border-radius: 50%;
-            background-color: #0068C9;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: white;
-        }
-        .assistant-avatar {
-            width: 40px;
-            height: 40px;
-            border-radius: 50%;
-            background-color: #09AB3B;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: white;
-        }
-        .chat-message {
-            padding: 1rem;
-            border-radius: 0.5rem;
-            margin-bottom: 1rem;
-            display: flex;
-            gap: 1rem;
-        }
-        .user-message {
-            background-color: #F0F2F6;
-        }
-        .assistant-message {
-            background-color: #FFFFFF;
-        }
-        </style>
-    """, unsafe_allow_html=True)
+    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
     # Chat title
     st.title("💬 Chat with Deepseek")
@@ -158,7 +309,9 @@ def main():
             st.write(message["content"])
 
     # Display token counter
-    display_token_counter()
+    if SHOW_USAGE:
+        usage_placeholder = st.sidebar.empty()
+        display_token_counter(usage_placeholder)
 
     # Chat input
     if prompt := st.chat_input("Send a message"):
@@ -168,39 +321,54 @@ def main():
 
         # Get and display assistant response
         with st.chat_message("assistant"):
+            thinking_placeholder = st.empty()
             message_placeholder = st.empty()
-            full_response = ""
-            thinking_displayed = False
+            # Split the stream into thinking/response as it arrives
+            # phase: "pre" (before <think>), "think" (inside), "post" (after </think>)
+            # A later <think> in the "post" phase starts another block to strip
+            stream = {"phase": "pre", "raw": [], "think": [], "resp": [], "thinking_displayed": False, "waiting": True}
+            # Show progress until the thinking section or the answer arrives
+            thinking_placeholder.status("💭 Thinking...")
             
             # Stream the response
-            for response_chunk, stats in get_ollama_response(prompt):
-                if response_chunk:
-                    full_response += response_chunk
-                    
-                    # Extract thinking and response
-                    thinking, current_response = extract_thinking_and_response(full_response)
-                    
-                    # Display thinking section if found and not already displayed
-                    if thinking and not thinking_displayed:
-                        display_thinking_section(thinking)
-                        thinking_displayed = True
-                    
-                    # Display the response without think tags
-                    message_placeholder.write(current_response + "▌")
-                elif stats:
-                    # Update token count from final stats
-                    if "prompt_eval_count" in stats:
-                        st.session_state.total_tokens += stats["prompt_eval_count"]
-                        display_token_counter()
+            failed = False
+            try:
+                with message_placeholder.container():
+                    st.write_stream(stream_response_text(prompt, stream, thinking_placeholder))
+            except requests.RequestException as e:
+                message_placeholder.error(f"Error from Ollama: {e}")
+                failed = True
+            
+            # Final update
+            if failed:
+                thinking, final_response = None, None
+            else:
+                streamed = "".join(stream["resp"]).strip()
+                if stream["phase"] == "post" and THINK_OPEN not in streamed:
+                    # Think blocks closed mid-stream, so the buffers are already split
+                    thinking = "".join(stream["think"]).strip()
+                    final_response = streamed
+                else:
+                    thinking, final_response = extract_thinking_and_response("".join(stream["raw"]))
+                    final_response = final_response.strip()
+                    if not thinking:
+                        thinking = "".join(stream["think"]).strip()
+                    # Tags split across chunks were streamed as text, so redraw
+                    if final_response != streamed:
+                        message_placeholder.write(final_response)
+            if thinking and not stream["thinking_displayed"]:
+                with thinking_placeholder:
+                    display_thinking_section(thinking)
+            elif stream["waiting"]:
+                thinking_placeholder.empty()
             
-            # Final update without cursor
-            thinking, final_response = extract_thinking_and_response(full_response)
-            if thinking and not thinking_displayed:
-                display_thinking_section(thinking)
-            message_placeholder.write(final_response)
+        # Update token counter once the response is complete
+        if SHOW_USAGE:
+            display_token_counter(usage_placeholder)
             
         # Add assistant response to chat history (without think tags)
-        st.session_state.messages.append({"role": "assistant", "content": final_response})
+        if final_response is not None:
+            st.session_state.messages.append({"role": "assistant", "content": final_response})
 
 if __name__ == "__main__":
     main()